@@ -33,6 +33,7 @@ OPTS+=" --warmup-iters 140"
 OPTS+=" --lr-decay-style constant"
 OPTS+=" --weight-decay 1e-2"
 OPTS+=" --clip-grad 1.0"
+OPTS+=" --offload-optimizer"
 OPTS+=" --loss-scale 128"
 # OPTS+=" --load ${BASE_PATH}/results/T5-${VERSION}.pt"
 
@@ -2,6 +2,7 @@ import time
 import random
 import os
 import csv
+import argparse
 
 import torch
 import numpy as np
@@ -9,7 +10,7 @@ from sklearn.metrics import accuracy_score, f1_score
 
 import bmtrain as bmt
 
-from model_center import get_args
+from model_center.arguments import add_model_config_args, add_training_args
 from model_center.model import T5, T5Config
 from model_center.tokenizer import T5Tokenizer
 from model_center.dataset.t5dataset import DATASET
@@ -17,19 +18,49 @@ from model_center.utils import print_inspect
 from model_center.dataset import DistributedDataLoader
 
 
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser = add_model_config_args(parser)
+    parser = add_training_args(parser)
+
+    group = parser.add_argument_group('finetune', 'options of this fine-tuning script')
+    group.add_argument('--log-interval', type=int, default=1,
+                       help='number of iterations between training logs')
+    group.add_argument('--grad-accum-steps', type=int, default=1,
+                       help='number of micro batches to accumulate gradients over before each optimizer step')
+    group.add_argument('--offload-optimizer', action='store_true',
+                       help='keep optimizer states on CPU to save GPU memory')
+    group.add_argument('--dtype', type=str, default='fp16',
+                       choices=['auto', 'fp16', 'bf16'],
+                       help='half precision format of the model, `auto` picks bf16 on GPUs that support it (compute capability >= 8.0) '
+                       'and fp16 otherwise. Loss scaling is only used for fp16')
+    group.add_argument('--compile', action='store_true',
+                       help='compile the model with torch.compile (requires torch>=2.0)')
+
+    # None tells an explicit --loss-scale apart from the default, which is applied in `initialize`
+    default_loss_scale = parser.get_default('loss_scale')
+    parser.set_defaults(loss_scale=None)
+
+    args = parser.parse_args()
+    args.default_loss_scale = default_loss_scale
+    return args
+
 def get_tokenizer(args):
     tokenizer = T5Tokenizer.from_pretrained(args.model_config)
     return tokenizer
 
 def get_model(args):
     # model = T5.from_pretrained(args.model_config)
-    config = T5Config.from_pretrained(args.model_config)
+    config = T5Config.from_pretrained(args.model_config, bf16 = args.dtype == "bf16")
     model = T5(config)
     bmt.init_parameters(model)
     return model
 
 def get_optimizer(args, model):
-    optimizer = bmt.optim.AdamOffloadOptimizer(model.parameters(), weight_decay=args.weight_decay)
+    if args.offload_optimizer:
+        optimizer = bmt.optim.AdamOffloadOptimizer(model.parameters(), weight_decay=args.weight_decay)
+    else:
+        optimizer = bmt.optim.AdamOptimizer(model.parameters(), weight_decay=args.weight_decay)
     return optimizer
 
 def get_learning_rate_scheduler(args, optimizer):
@@ -75,6 +106,9 @@ def setup_model_and_optimizer(args):
     tokenizer = get_tokenizer(args)
     # get the model
     model = get_model(args)
+    if args.compile:
+        # dynamic shapes, since encoder and decoder lengths vary between datasets
+        model = torch.compile(model, dynamic=True)
     bmt.synchronize()
     # get the optimizer and lr_scheduler
     optimizer = get_optimizer(args, model)
@@ -90,6 +124,13 @@ def initialize():
     args = get_args()
     # init bmt 
     bmt.init_distributed(seed = args.seed)
+    if args.dtype == "auto":
+        args.dtype = "bf16" if torch.cuda.get_device_capability()[0] >= 8 else "fp16"
+    if args.dtype == "bf16":
+        if args.loss_scale is not None:
+            bmt.print_rank("WARNING: --loss-scale {} is ignored, loss scaling is not used for bf16".format(args.loss_scale))
+    elif args.loss_scale is None:
+        args.loss_scale = args.default_loss_scale
     # init save folder
     if args.save != None:
         os.makedirs(args.save, exist_ok=True)
@@ -105,132 +146,161 @@ def prepare_dataset(args, tokenizer, base_path, dataset_name, rank, world_size):
     return dataset, verbalizer
 
 
+def select_verbalizer_logits(logits, index, verbalizer):
+    # each sample has exactly one position marked in `index`, so a gather keeps the shape
+    # static and avoids the host sync of boolean indexing
+    position = index.argmax(dim=-1).long()
+    logits = logits.gather(1, position.view(-1, 1, 1).expand(-1, 1, logits.size(-1))).squeeze(1)  # (batch, vocab_size)
+    return logits.index_select(dim=-1, index=verbalizer)  # (batch, num_labels)
+
+
 def finetune(args, tokenizer, model, optimizer, lr_scheduler, dataset, verbalizer):
     output_dir = '../result/{}/{}/'\
         .format(args.model_config, args.dataset_name)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    if args.local_rank == 0:
-        with open(os.path.join(output_dir, "token.txt"), "w") as f:
-            time_tuple = time.localtime(time.time())
-            print('Time {}/{:02d}/{:02d} {:02d}:{:02d}:{:02d}:'
-                .format(time_tuple[0], time_tuple[1], time_tuple[2], time_tuple[3],
-                        time_tuple[4], time_tuple[5]), file=f)
     loss_func = bmt.loss.FusedCrossEntropy(ignore_index=-100)
 
-    optim_manager = bmt.optim.OptimManager(loss_scale=args.loss_scale, loss_scale_steps=100)
+    # bf16 has the exponent range of fp32 and does not need loss scaling
+    loss_scale = args.loss_scale if args.dtype == "fp16" else None
+    optim_manager = bmt.optim.OptimManager(loss_scale=loss_scale, loss_scale_steps=100)
     optim_manager.add_optimizer(optimizer, lr_scheduler)
 
     # print_inspect(model, '*')
 
     bmt.print_rank(verbalizer)
 
-    for epoch in range(20):
-        dataloader = {
-            "train": DistributedDataLoader(dataset['train'], batch_size=args.batch_size, shuffle=True),
-            "dev": DistributedDataLoader(dataset['dev'], batch_size=args.batch_size, shuffle=False),
-        }
+    # built once, DistributedDataLoader advances the shuffling epoch itself on every pass
+    dataloader = {
+        "train": DistributedDataLoader(dataset['train'], batch_size=args.batch_size, shuffle=True),
+        "dev": DistributedDataLoader(dataset['dev'], batch_size=args.batch_size, shuffle=False),
+    }
 
-        model.train()
-        epoch_token_num = 0
-        epoch_time = 0
+    if args.local_rank == 0:
+        # opened once and line buffered, instead of reopened for every logged iteration
+        token_file = open(os.path.join(output_dir, "token.txt"), "w", buffering=1)
+    try:
         if args.local_rank == 0:
-            with open(os.path.join(output_dir, "token.txt"), "a") as f:
-                print("Epoch {}:".format(epoch+1), file=f)
-        for it, data in enumerate(dataloader['train']):
-            enc_input = data["enc_input"]
-            enc_length = data["enc_length"]
-            dec_input = data["dec_input"]
-            dec_length = data["dec_length"]
-            targets = data["targets"]
-            index = data["index"]
-            batch_token_num = enc_input.numel() + dec_input.numel()
-            epoch_token_num += batch_token_num
-            
+            time_tuple = time.localtime(time.time())
+            print('Time {}/{:02d}/{:02d} {:02d}:{:02d}:{:02d}:'
+                .format(time_tuple[0], time_tuple[1], time_tuple[2], time_tuple[3],
+                        time_tuple[4], time_tuple[5]), file=token_file)
+        grad_norm = 0
+        for epoch in range(20):
+            model.train()
+            epoch_token_num = 0
+            epoch_time = 0
+            # summed on device and only synchronized with the host every `log_interval` iterations,
+            # together with the timing of the whole log window
+            log_loss = torch.zeros((), dtype=torch.float32, device="cuda")
+            log_iters = 0
+            log_token_num = 0
+            if args.local_rank == 0:
+                print("Epoch {}:".format(epoch+1), file=token_file)
             torch.cuda.synchronize()
-            st_time = time.time()
+            log_start_time = time.time()
+            for it, data in enumerate(dataloader['train']):
+                enc_input = data["enc_input"]
+                enc_length = data["enc_length"]
+                dec_input = data["dec_input"]
+                dec_length = data["dec_length"]
+                targets = data["targets"]
+                index = data["index"]
+                batch_token_num = enc_input.numel() + dec_input.numel()
+                epoch_token_num += batch_token_num
+                log_token_num += batch_token_num
 
-            logits = model(enc_input, enc_length, dec_input, dec_length, output_logits=True).logits
-            logits = logits.index_select(dim=-1, index=verbalizer)
-            logits = logits[torch.where(index==1)]
+                logits = model(enc_input, enc_length, dec_input, dec_length, output_logits=True).logits
+                logits = select_verbalizer_logits(logits, index, verbalizer)
 
-            loss = loss_func(logits, targets)
-            global_loss = bmt.sum_loss(loss).item()
+                loss = loss_func(logits, targets)
+                log_loss += loss.detach().float()
+                log_iters += 1
 
-            optim_manager.zero_grad()
+                if it % args.grad_accum_steps == 0:
+                    optim_manager.zero_grad()
 
-            optim_manager.backward(loss)
-            grad_norm = optim_manager.clip_grad_norm(optimizer.param_groups, args.clip_grad, norm_type = 2)
+                optim_manager.backward(loss / args.grad_accum_steps)
 
-            optim_manager.step()
-            
-            torch.cuda.synchronize()
-            elapsed_time = time.time() - st_time
-            epoch_time += elapsed_time
-
-            bmt.print_rank(
-                "train | epoch {:3d} | Iter: {:6d}/{:6d} | loss: {:.4f} | lr: {:.4e}, scale: {:10.4f} | grad_norm: {:.4f} | time: {:.3f} | tokens/s: {:.1f}".format(
-                    epoch,
-                    it,
-                    len(dataloader["train"]),
-                    global_loss,
-                    lr_scheduler.current_lr,
-                    int(optim_manager.loss_scale),
-                    grad_norm,
-                    elapsed_time,
-                    batch_token_num * 8/ elapsed_time,
-                )
-            )
-            if args.local_rank == 0:
-                with open(os.path.join(output_dir, "token.txt"), "a") as f:
-                    print("    iter {}: {:.1f} token/s".format(it, batch_token_num * 8 / elapsed_time), file=f)
-            # if it % args.inspect_iters == 0: print_inspect(model, "*")
-            # if args.save != None and it % args.save_iters == 0:
-            #     bmt.save(model, os.path.join(args.save, args.save_name+("-%d.pt" % it)))
-        if args.local_rank == 0:
-            with open(os.path.join(output_dir, "token.txt"), "a") as f:
-                print("    batch {}: {:.1f} token/s".format(epoch+1, epoch_token_num * 8 / epoch_time), file=f)
-        model.eval()
-        with torch.no_grad():
-            for split in ['dev']:
-                pd = []
-                gt = []
-                for it, data in enumerate(dataloader[split]):
-                    enc_input = data["enc_input"]
-                    enc_length = data["enc_length"]
-                    dec_input = data["dec_input"]
-                    dec_length = data["dec_length"]
-                    targets = data["targets"]
-                    index = data["index"]
-
-                    logits = model(enc_input, enc_length, dec_input, dec_length, output_logits=True).logits
-                    logits = logits.index_select(dim=-1, index=verbalizer)
-                    logits = logits[torch.where(index==1)]
-                    logits = logits.argmax(dim=-1)
-                
-                    pd.extend(logits.cpu().tolist())
-                    gt.extend(targets.cpu().tolist())
+                if (it + 1) % args.grad_accum_steps == 0 or it + 1 == len(dataloader['train']):
+                    grad_norm = optim_manager.clip_grad_norm(optimizer.param_groups, args.clip_grad, norm_type = 2)
+                    optim_manager.step()
 
+                if (it + 1) % args.log_interval == 0 or it + 1 == len(dataloader['train']):
+                    global_loss = bmt.sum_loss(log_loss / log_iters).item()
+                    torch.cuda.synchronize()
+                    elapsed_time = time.time() - log_start_time
+                    epoch_time += elapsed_time
                     bmt.print_rank(
-                        "{} | epoch {:3d} | Iter: {:6d}/{:6d} |".format(
-                            split,
+                        "train | epoch {:3d} | Iter: {:6d}/{:6d} | loss: {:.4f} | lr: {:.4e}, scale: {:10.4f} | grad_norm: {:.4f} | time: {:.3f} | tokens/s: {:.1f}".format(
                             epoch,
                             it,
-                            len(dataloader[split]),
+                            len(dataloader["train"]),
+                            global_loss,
+                            lr_scheduler.current_lr,
+                            int(optim_manager.loss_scale),
+                            grad_norm,
+                            elapsed_time / log_iters,
+                            log_token_num * 8 / elapsed_time,
                         )
                     )
-                pd = bmt.gather_result(torch.tensor(pd).int()).cpu().tolist()
-                gt = bmt.gather_result(torch.tensor(gt).int()).cpu().tolist()
-                bmt.print_rank(pd)
-                bmt.print_rank(gt)
+                    if args.local_rank == 0:
+                        print("    iter {}: {:.1f} token/s".format(it, log_token_num * 8 / elapsed_time), file=token_file)
+                    log_loss.zero_()
+                    log_iters = 0
+                    log_token_num = 0
+                    log_start_time = time.time()
+                # if it % args.inspect_iters == 0: print_inspect(model, "*")
+                # if args.save != None and it % args.save_iters == 0:
+                #     bmt.save(model, os.path.join(args.save, args.save_name+("-%d.pt" % it)))
+            if args.local_rank == 0:
+                print("    batch {}: {:.1f} token/s".format(epoch+1, epoch_token_num * 8 / epoch_time), file=token_file)
+            model.eval()
+            with torch.no_grad():
+                for split in ['dev']:
+                    pd = []
+                    gt = []
+                    for it, data in enumerate(dataloader[split]):
+                        enc_input = data["enc_input"]
+                        enc_length = data["enc_length"]
+                        dec_input = data["dec_input"]
+                        dec_length = data["dec_length"]
+                        targets = data["targets"]
+                        index = data["index"]
+
+                        logits = model(enc_input, enc_length, dec_input, dec_length, output_logits=True).logits
+                        logits = select_verbalizer_logits(logits, index, verbalizer)
+                        logits = logits.argmax(dim=-1)
                 
-                bmt.print_rank(f"{split} epoch {epoch}:")
-                if args.dataset_name in ["BoolQ", "CB", "COPA", "RTE", "WiC", "WSC"]:
-                    acc = accuracy_score(gt, pd)
-                    bmt.print_rank(f"accuracy: {acc*100:.2f}")
-                if args.dataset_name in ["CB"]:
-                    f1 = f1_score(gt, pd, average="macro")
-                    bmt.print_rank(f"Average F1: {f1*100:.2f}")
+                        # kept on device, copied to the host once after the loop
+                        pd.append(logits)
+                        gt.append(targets)
+
+                        if (it + 1) % args.log_interval == 0 or it + 1 == len(dataloader[split]):
+                            bmt.print_rank(
+                                "{} | epoch {:3d} | Iter: {:6d}/{:6d} |".format(
+                                    split,
+                                    epoch,
+                                    it,
+                                    len(dataloader[split]),
+                                )
+                            )
+                    # sklearn takes the arrays directly, no need to box every label into a Python int
+                    pd = bmt.gather_result(torch.cat(pd).int()).cpu().numpy()
+                    gt = bmt.gather_result(torch.cat(gt).int()).cpu().numpy()
+                    bmt.print_rank(pd)
+                    bmt.print_rank(gt)
+                
+                    bmt.print_rank(f"{split} epoch {epoch}:")
+                    if args.dataset_name in ["BoolQ", "CB", "COPA", "RTE", "WiC", "WSC"]:
+                        acc = accuracy_score(gt, pd)
+                        bmt.print_rank(f"accuracy: {acc*100:.2f}")
+                    if args.dataset_name in ["CB"]:
+                        f1 = f1_score(gt, pd, average="macro")
+                        bmt.print_rank(f"Average F1: {f1*100:.2f}")
+    finally:
+        if args.local_rank == 0:
+            token_file.close()
 
 
 def main():
@@ -85,6 +85,7 @@ class CPM1_Dataset_Merge(data.Dataset):
         if ctx.shape[0] > self.max_length:
             return None, None, None, None
         len_ctx = min(ctx.shape[0], self.max_length)
+        ctx = ctx.astype('int64')
         lef = random.randint(len_ctx // 8, len_ctx // 4)
         rig = random.randint(len_ctx // 4 * 3, len_ctx)
         if ctx[len_ctx-1] == 4:
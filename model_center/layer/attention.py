@@ -21,6 +21,10 @@ import bmtrain as bmt
 import torch.nn.functional as F
 from .linear import Linear
 
+# the `scale` argument of F.scaled_dot_product_attention is available since torch 2.1
+_fused_attention_available = hasattr(F, "scaled_dot_product_attention") and \
+    tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
+
 
 class Attention(bmt.DistributedModule):
 
@@ -66,33 +70,11 @@ class Attention(bmt.DistributedModule):
 
         num_heads_kv = 1 if shared_key_and_value else num_heads 
 
-        self.project_q = Linear(
-            dim_in = dim_in,
-            dim_out = num_heads * dim_head,
-            length_scale = length_scale,
-            length_scale_before = False,
-            dtype = dtype,
-            int8 = int8,
-            init_mean = init_mean,
-            init_std = init_std,
-            bias = bias,
-        )
-
-        self.project_k = Linear(
-            dim_in = dim_in,
-            dim_out = num_heads_kv * dim_head,
-            length_scale = length_scale,
-            length_scale_before = False,
-            dtype = dtype,
-            int8 = int8,
-            init_mean = init_mean,
-            init_std = init_std,
-            bias = bias,
-        )
-
-        self.project_v = Linear(
+        # query, key and value projections are stored as a single matrix, so that
+        # self-attention only needs one GEMM
+        self.project_qkv = Linear(
             dim_in = dim_in,
-            dim_out = num_heads_kv * dim_head,
+            dim_out = (num_heads + 2 * num_heads_kv) * dim_head,
             length_scale = length_scale,
             length_scale_before = False,
             dtype = dtype,
@@ -137,6 +119,15 @@ class Attention(bmt.DistributedModule):
         self.pos_bias_type = pos_bias_type
         self.softmax = torch.nn.Softmax(dim=-1)
 
+        self._register_load_state_dict_pre_hook(self._fuse_legacy_projections)
+
+    def _fuse_legacy_projections(self, state_dict, prefix, *args):
+        # checkpoints saved before the fusion hold separate `project_q`, `project_k` and `project_v`
+        for param in ["weight", "bias"]:
+            keys = [f"{prefix}project_{name}.{param}" for name in ["q", "k", "v"]]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}project_qkv.{param}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
     def forward(self, query : torch.Tensor,
                       key_value : torch.Tensor,
                       attention_mask : torch.Tensor,
@@ -161,12 +152,18 @@ class Attention(bmt.DistributedModule):
         len_q = query.size(1)
         len_k = key_value.size(1)
 
-        h_q = self.project_q(query)             # (batch, len_q, num_heads * dim_head)
-        self.flops = self.project_q.flops
-        h_k = self.project_k(key_value)         # (batch, len_k, num_heads * dim_head)
-        self.flops += self.project_k.flops
-        h_v = self.project_v(key_value)         # (batch, len_k, num_heads * dim_head)
-        self.flops += self.project_v.flops
+        dim_q = self.num_heads * self.dim_head
+        dim_kv = self.num_heads_kv * self.dim_head
+        if query is key_value:
+            h_qkv = self.project_qkv(query)     # (batch, len_q, (num_heads + 2 * num_heads_kv) * dim_head)
+            self.flops = self.project_qkv.flops
+            h_q, h_k, h_v = h_qkv.split([dim_q, dim_kv, dim_kv], dim=-1)
+        else:
+            h_q = self.project_qkv(query, slice(0, dim_q))          # (batch, len_q, num_heads * dim_head)
+            self.flops = self.project_qkv.flops
+            h_kv = self.project_qkv(key_value, slice(dim_q, None))  # (batch, len_k, 2 * num_heads_kv * dim_head)
+            self.flops += self.project_qkv.flops
+            h_k, h_v = h_kv.split([dim_kv, dim_kv], dim=-1)
 
         h_q = h_q.view(batch_size, len_q, self.num_heads, self.dim_head).permute(0, 2, 1, 3)   # (batch, num_heads, len_q, dim_head)
         h_k = h_k.view(batch_size, len_k, self.num_heads_kv, self.dim_head).permute(0, 2, 1, 3)   # (batch, num_heads_kv, len_k, dim_head)
@@ -176,9 +173,8 @@ class Attention(bmt.DistributedModule):
         #     h_k = h_k.repeat(1, self.num_heads, 1, 1)
         #     h_v = h_v.repeat(1, self.num_heads, 1, 1)
 
-        h_q = h_q.contiguous()      # (batch * num_heads, len_q, dim_head)
-        h_k = h_k.contiguous()      # (batch * num_heads, len_k, dim_head)
-        h_v = h_v.contiguous()      # (batch * num_heads, len_k, dim_head)
+        # torch.matmul and F.scaled_dot_product_attention take the strided (batch, num_heads, len, dim_head)
+        # views directly, so no contiguous copy is made here
 
         if past_key_value is not None:
             h_k = torch.cat([past_key_value[0], h_k], dim=-2)
@@ -190,45 +186,21 @@ class Attention(bmt.DistributedModule):
         if self.pos_bias_type == "rotary":
             h_q, h_k = position_bias(h_q, h_k)
 
-        # (batch, num_heads, len_q, dim_head) @ (batch, num_heads_kv, len_k, dim_head)T 
-        # => (batch, num_heads, len_q, len_k)
-        
-        score = torch.matmul(h_q, h_k.transpose(2, 3))
-        if self.attn_scale:
-            score = score / math.sqrt(self.dim_head)
-
-        # (batch, num_heads, len_q, len_k) 
-        # score = score.view(batch_size, self.num_heads, len_q, len_k)
-
-        if self.pos_bias_type == "relative":
-            if position_bias is not None:
-                # (batch, num_heads, len_q, len_k) + (1, num_heads, len_q, len_k) 
-                score = score + position_bias
-        
-        score = torch.masked_fill(
-            score,
-            attention_mask.view(batch_size, 1, len_q, len_k)==False,
-            torch.scalar_tensor(self.mask_value, device=score.device, dtype=score.dtype)
-        )   # (batch, num_heads, len_q, len_k)
-
-        score = self.softmax(score)
+        attn_bias = self._attention_bias(h_q, h_k, attention_mask, position_bias)
+        if _fused_attention_available:
+            score = self._fused_attention(h_q, h_k, h_v, attn_bias)
+        else:
+            score = self._attention(h_q, h_k, h_v, attn_bias)
+        self.flops += 2 * score.numel() * h_v.shape[-1]
 
-        # avoid nan in softmax
+        # queries without any visible key attend to nothing
         score = torch.masked_fill(
             score,
-            attention_mask.view(batch_size, 1, len_q, len_k)==False,
+            attention_mask.view(batch_size, 1, len_q, len_k).any(dim=-1, keepdim=True)==False,
             torch.scalar_tensor(0, device=score.device, dtype=score.dtype)
         )
-        #.view(batch_size * self.num_heads, len_q, len_k) # (batch * num_heads, len_q, len_k)
 
-        if self.attention_dropout is not None:
-            score = self.attention_dropout(score)
-
-         # (batch * num_heads, len_q, len_k) @ (batch * num_heads, len_k, dim_head) = (batch * num_heads, len_q, dim_head)
-        score = torch.matmul(score, h_v)
-        self.flops += 2 * score.numel() * h_v.shape[-1]
-
-        score = score.view(batch_size, self.num_heads, len_q, self.dim_head).permute(0, 2, 1, 3) # (batch, len_q, num_heads, dim_head)
+        score = score.permute(0, 2, 1, 3) # (batch, len_q, num_heads, dim_head)
         score = score.reshape(batch_size, len_q, self.num_heads * self.dim_head) # (batch, len_q, num_heads * dim_head)
 
         # (1#batch, dim_model, num_heads * dim_head) @ (batch, num_heads * dim_head, len_q) = (batch, dim_model, len_q)
@@ -240,6 +212,93 @@ class Attention(bmt.DistributedModule):
         else:
             return score
 
+    def _attention_bias(self, h_q : torch.Tensor,
+                              h_k : torch.Tensor,
+                              attention_mask : torch.Tensor,
+                              position_bias : Optional[torch.Tensor] = None,
+        ):
+        """ Folds the attention mask and the relative position bias into a single additive bias, which is built once and added to the scores before softmax.
+
+        Args:
+            h_q (:obj:`torch.Tensor` of shape ``(batch, num_heads, len_q, dim_head)``): Projected query.
+            h_k (:obj:`torch.Tensor` of shape ``(batch, num_heads_kv, len_k, dim_head)``): Projected key.
+            attention_mask (:obj:`torch.Tensor` of shape ``(batch, len_q, len_k)``): Used to avoid performing attention on padding token indices.
+            position_bias(:obj:`torch.Tensor` of shape ``(num_heads, len_q, len_k)`` or ``(1, num_heads, len_k, len_q)``): Relative position bias.
+
+        Return:
+            out (:obj:`torch.Tensor` of shape ``(batch, num_heads, len_q, len_k)`` or ``(batch, 1, len_q, len_k)``): The additive attention bias.
+        """
+        batch_size, _, len_q, _ = h_q.size()
+        len_k = h_k.size(-2)
+
+        # -inf would turn fully masked rows into nan, use a finite value instead, with a margin so that
+        # adding it to negative half precision scores does not overflow to -inf either
+        mask_value = max(self.mask_value, torch.finfo(h_q.dtype).min / 2)
+        if self.pos_bias_type == "relative" and position_bias is not None:
+            attn_bias = position_bias.to(h_q.dtype)
+        else:
+            attn_bias = torch.zeros((1, 1, len_q, len_k), device=h_q.device, dtype=h_q.dtype)
+        attn_bias = torch.masked_fill(
+            attn_bias,
+            attention_mask.view(batch_size, 1, len_q, len_k)==False,
+            torch.scalar_tensor(mask_value, device=h_q.device, dtype=h_q.dtype)
+        )
+        return attn_bias
+
+    def _fused_attention(self, h_q : torch.Tensor,
+                               h_k : torch.Tensor,
+                               h_v : torch.Tensor,
+                               attn_bias : torch.Tensor,
+        ):
+        """ Computes the attention with the fused kernel of `F.scaled_dot_product_attention`, without materializing the softmax scores.
+
+        Args:
+            h_q (:obj:`torch.Tensor` of shape ``(batch, num_heads, len_q, dim_head)``): Projected query.
+            h_k (:obj:`torch.Tensor` of shape ``(batch, num_heads_kv, len_k, dim_head)``): Projected key.
+            h_v (:obj:`torch.Tensor` of shape ``(batch, num_heads_kv, len_k, dim_head)``): Projected value.
+            attn_bias (:obj:`torch.Tensor` of shape ``(batch, num_heads, len_q, len_k)`` or ``(batch, 1, len_q, len_k)``): Additive bias from :py:meth:`_attention_bias`.
+
+        Return:
+            out (:obj:`torch.Tensor` of shape ``(batch, num_heads, len_q, dim_head)``): The attention context.
+        """
+        if self.num_heads_kv != self.num_heads:
+            h_k = h_k.expand(-1, self.num_heads, -1, -1)
+            h_v = h_v.expand(-1, self.num_heads, -1, -1)
+
+        score = F.scaled_dot_product_attention(
+            h_q, h_k, h_v,
+            attn_mask = attn_bias,
+            dropout_p = self.dropout_p if self.training else 0.0,
+            scale = None if self.attn_scale else 1.0,
+        )   # (batch, num_heads, len_q, dim_head)
+        return score
+
+    def _attention(self, h_q : torch.Tensor,
+                         h_k : torch.Tensor,
+                         h_v : torch.Tensor,
+                         attn_bias : torch.Tensor,
+        ):
+        """ Computes the attention explicitly, used when the fused kernel is not available. Arguments are the same as :py:meth:`_fused_attention`.
+        """
+        # (batch, num_heads, len_q, dim_head) @ (batch, num_heads_kv, len_k, dim_head)T
+        # => (batch, num_heads, len_q, len_k)
+
+        score = torch.matmul(h_q, h_k.transpose(2, 3))
+        if self.attn_scale:
+            score = score / math.sqrt(self.dim_head)
+
+        # (batch, num_heads, len_q, len_k) + (batch, num_heads or 1, len_q, len_k)
+        score = score + attn_bias
+
+        score = self.softmax(score)
+
+        if self.attention_dropout is not None:
+            score = self.attention_dropout(score)
+
+        # (batch, num_heads, len_q, len_k) @ (batch, num_heads_kv, len_k, dim_head) = (batch, num_heads, len_q, dim_head)
+        score = torch.matmul(score, h_v)
+        return score
+
 
 class SparseSelfAttention(Attention):
 
@@ -310,13 +369,11 @@ class SparseSelfAttention(Attention):
 
         hidden_states = hidden_states.transpose(0, 1)
         # project hidden states
-        query_vectors = self.project_q(hidden_states)
-        self.flops = self.project_q.flops
-        key_vectors = self.project_k(hidden_states)
-        self.flops += self.project_k.flops
-        value_vectors = self.project_v(hidden_states)
-        self.flops += self.project_v.flops
-        query_vectors /= math.sqrt(self.dim_head)
+        dim_q = self.num_heads * self.dim_head
+        dim_kv = self.num_heads_kv * self.dim_head
+        query_vectors, key_vectors, value_vectors = self.project_qkv(hidden_states).split([dim_q, dim_kv, dim_kv], dim=-1)
+        self.flops = self.project_qkv.flops
+        query_vectors = query_vectors / math.sqrt(self.dim_head)
         self.flops += query_vectors.numel()
         seq_len, batch_size, embed_dim = query_vectors.size()
 
@@ -15,18 +15,33 @@
 
 import torch
 import bmtrain as bmt
+import torch.nn.functional as F
 
 from .linear import Linear
 
-import math
-
 @torch.jit.script
 def gelu_new(x):
     """
     Implementation of the GELU activation function currently in Google BERT repo (identical to OpenAI GPT). Also see
     the Gaussian Error Linear Units paper: https://arxiv.org/abs/1606.08415
     """
-    return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
+    # same formula as 0.5 * x * (1 + tanh(sqrt(2 / pi) * (x + 0.044715 * x^3))), computed by a single kernel
+    return F.gelu(x, approximate="tanh")
+
+@torch.jit.script
+def gated_relu(x):
+    gate_score, x = x.chunk(2, dim=-1)
+    return torch.relu(gate_score) * x
+
+@torch.jit.script
+def gated_gelu(x):
+    gate_score, x = x.chunk(2, dim=-1)
+    return F.gelu(gate_score) * x
+
+@torch.jit.script
+def gated_gelu_new(x):
+    gate_score, x = x.chunk(2, dim=-1)
+    return gelu_new(gate_score) * x
 
 class DenseGatedACT(bmt.DistributedModule):
 
@@ -43,21 +58,10 @@ class DenseGatedACT(bmt.DistributedModule):
         ):
         super().__init__()
 
-        self.w_0 = Linear(
-            dim_in = dim_in,
-            dim_out = dim_ff,
-            length_scale = length_scale,
-            length_scale_before = False,
-            dtype = dtype,
-            int8 = int8,
-            init_mean = init_mean,
-            init_std = init_std,
-            bias = bias,
-        )
-
-        self.w_1 = Linear(
+        # w_0 (gate) and w_1 are stored as a single matrix, so that both are computed by one GEMM
+        self.w_01 = Linear(
             dim_in = dim_in,
-            dim_out = dim_ff,
+            dim_out = 2 * dim_ff,
             length_scale = length_scale,
             length_scale_before = False,
             dtype = dtype,
@@ -68,13 +72,22 @@ class DenseGatedACT(bmt.DistributedModule):
         )
 
         if activate_fn == "relu":
-            self.act = torch.nn.ReLU()
+            self.gated_act = gated_relu
         elif activate_fn == "gelu":
-            self.act = torch.nn.GELU()
+            self.gated_act = gated_gelu
         elif activate_fn == "gelu_new":
-            self.act = gelu_new
+            self.gated_act = gated_gelu_new
         else:
             raise ValueError("Unsupported activation function: %s" % (activate_fn))
+
+        self._register_load_state_dict_pre_hook(self._fuse_legacy_projections)
+
+    def _fuse_legacy_projections(self, state_dict, prefix, *args):
+        # checkpoints saved before the fusion hold separate `w_0` and `w_1`
+        for param in ["weight", "bias"]:
+            keys = [f"{prefix}w_{i}.{param}" for i in range(2)]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}w_01.{param}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
     
     def forward(self, x : torch.Tensor):
         """ This model inherits from bmt.DistributedModule. 
@@ -87,10 +100,10 @@ class DenseGatedACT(bmt.DistributedModule):
             out (:obj:`torch.Tensor` of shape ``(batch, seq_len, dim_ff)``) 
 
         """
-        gate_score = self.act( self.w_0(x) )
-        x = self.w_1(x)
+        x = self.w_01(x)
+        x = self.gated_act(x)
+        self.flops = self.w_01.flops + 2 * x.numel()
 
-        x = gate_score * x
         return x
 
 
@@ -16,6 +16,7 @@
 import torch
 import bmtrain as bmt
 import math
+from typing import Optional
 import torch.nn.functional as F
 
 class Linear(bmt.DistributedModule):
@@ -55,24 +56,33 @@ class Linear(bmt.DistributedModule):
         self.length_scale_before = length_scale_before
         self.int8 = int8
 
-    def forward(self, x : torch.Tensor):
+    def forward(self, x : torch.Tensor, out_slice : Optional[slice] = None):
         """ 
         Args:
             x (:obj:`torch.Tensor` of shape ``(batch, seq_len, dim_in)``): The input of linear layer
+            out_slice (:obj:`slice`, optional): Only compute the output features in this range. Defaults to None, which means all of them.
 
         Returns:
             :obj:`torch.Tensor` of shape ``(batch, seq_len, dim_out)``: The output of the linear transform y.
 
         """
-        self.flops = 2 * x.numel() * self.weight.shape[0]
+        weight = self.weight if out_slice is None else self.weight[out_slice]
+        bias = self.bias if self.bias is None or out_slice is None else self.bias[out_slice]
+        self.flops = 2 * x.numel() * weight.shape[0]
         if self.length_scale and self.length_scale_before:
             x = x / math.sqrt(self.dim_in)
             self.flops += x.numel()
-        x = F.linear(x, self.weight)
-        if self.length_scale and not self.length_scale_before:
-            x = x / math.sqrt(self.dim_in)
+        scale_after = self.length_scale and not self.length_scale_before
+        # the bias is added in the GEMM epilogue, unless the output has to be scaled first
+        matmul_bias = None if scale_after else bias
+        x = F.linear(x, weight, matmul_bias)
+        if scale_after:
+            if bias is not None:
+                # bias + x / sqrt(dim_in) in a single kernel
+                x = torch.add(bias, x, alpha=1 / math.sqrt(self.dim_in))
+            else:
+                x = x / math.sqrt(self.dim_in)
             self.flops += x.numel()
-        if self.bias is not None:
-            x = x + self.bias
+        if bias is not None:
             self.flops += x.numel()
         return x
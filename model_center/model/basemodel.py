@@ -46,6 +46,19 @@ class BaseModel(torch.nn.Module):
     def state_dict(self, destination=None, prefix='', keep_vars=False):
         return bmt.store._save_to_rank0(self, destination, prefix)
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # torch does not recurse into bmt.CheckpointBlock when loading, so the load pre-hooks of the layers
+        # inside it, e.g. the conversion of checkpoints saved before the projection fusions, are run here
+        metadata = getattr(state_dict, "_metadata", {})
+        for block_name, block in self.named_modules(prefix=prefix[:-1]):
+            if isinstance(block, bmt.CheckpointBlock):
+                for name, module in block.named_modules(prefix=block_name):
+                    if module is block:
+                        continue
+                    for hook in module._load_state_dict_pre_hooks.values():
+                        hook(state_dict, name + ".", metadata.get(name, {}), strict, missing_keys, unexpected_keys, error_msgs)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
 class ModelOutput(OrderedDict):
     """
     This code follows the output implementation of HuggingFace Transformers, which
@@ -59,6 +59,7 @@ class T5Config(Config):
                        length_scale = False, 
                        attn_scale = False,
                        half = True,
+                       bf16 = False,
                        int8 = False,
                        tied = True,
                        cls_head = None,
@@ -103,7 +104,7 @@ class T5Config(Config):
         self.tied = tied
         self.scale = scale
         if half: 
-            self.dtype = torch.half
+            self.dtype = torch.bfloat16 if bf16 else torch.half
         else:
             self.dtype = torch.float
         self.cls_head = cls_head
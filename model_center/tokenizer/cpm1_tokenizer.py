@@ -89,32 +89,26 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # no substring longer than the longest vocabulary entry can match
+        self.max_token_chars = max(len(v) for v in vocab)
 
     def tokenize(self, token):
 
         token = convert_to_unicode(token)
 
-        chars = list(token)
-        if len(chars) > self.max_input_chars_per_word:
+        if len(token) > self.max_input_chars_per_word:
             return [self.unk_token]
 
         start = 0
         sub_tokens = []
-        while start < len(chars):
-            end = len(chars)
+        while start < len(token):
+            end = min(len(token), start + self.max_token_chars)
             cur_substr = None
             while start < end:
-                substr = "".join(chars[start:end])
-                if is_contain_chinese(substr) or is_contain_point(substr):
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                else:
-                    # if start > 0:
-                    #     substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
+                substr = token[start:end]
+                if substr in self.vocab:
+                    cur_substr = substr
+                    break
                 end -= 1
             if cur_substr is None:
                 sub_tokens.append(self.unk_token)
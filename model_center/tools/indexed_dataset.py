@@ -19,8 +19,11 @@ from itertools import accumulate
 import numpy as np
 import torch
 
+# builders append many small items, buffer them into few large writes
+_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
 
-def __best_fitting_dtype(vocab_size=None):
+
+def best_fitting_dtype(vocab_size=None):
     if vocab_size is not None and vocab_size < 65500:
         return np.uint16
     else:
@@ -272,7 +275,7 @@ class IndexedDatasetBuilder(object):
     }
 
     def __init__(self, out_file, dtype=np.int32):
-        self.out_file = open(out_file, 'wb')
+        self.out_file = open(out_file, 'wb', buffering=_WRITE_BUFFER_SIZE)
         self.dtype = dtype
         self.data_offsets = [0]
         self.dim_offsets = [0]
@@ -281,11 +284,19 @@ class IndexedDatasetBuilder(object):
         self.doc_idx = [0]
 
     def add_item(self, tensor):
-        bytes = self.out_file.write(np.array(tensor.numpy(), dtype=self.dtype))
+        np_array = np.asarray(tensor, dtype=self.dtype)
+        bytes = self.out_file.write(np_array)
         self.data_offsets.append(self.data_offsets[-1] + bytes / self.element_size)
-        for s in tensor.size():
+        for s in np_array.shape:
             self.sizes.append(s)
-        self.dim_offsets.append(self.dim_offsets[-1] + len(tensor.size()))
+        self.dim_offsets.append(self.dim_offsets[-1] + np_array.ndim)
+
+    def add_buffer(self, tensor, sizes):
+        # several 1-d items stored back to back in `tensor`, `sizes` holds their lengths
+        if len(sizes) == 0:
+            return
+        for item in np.split(np.asarray(tensor), np.cumsum(sizes)[:-1]):
+            self.add_item(item)
 
     def end_document(self):
         self.doc_idx.append(len(self.sizes))
@@ -538,16 +549,23 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
 class MMapIndexedDatasetBuilder(object):
     def __init__(self, out_file, dtype=np.int64):
-        self._data_file = open(out_file, 'wb')
+        self._data_file = open(out_file, 'wb', buffering=_WRITE_BUFFER_SIZE)
         self._dtype = dtype
         self._sizes = []
         self._doc_idx = [0]
 
     def add_item(self, tensor):
-        np_array = np.array(tensor.numpy(), dtype=self._dtype)
+        # accepts numpy arrays as well as CPU tensors, without a copy when the dtype already matches
+        np_array = np.asarray(tensor, dtype=self._dtype)
         self._data_file.write(np_array.tobytes(order='C'))
         self._sizes.append(np_array.size)
 
+    def add_buffer(self, tensor, sizes):
+        # several items stored back to back in `tensor`, `sizes` holds their lengths
+        np_array = np.asarray(tensor, dtype=self._dtype)
+        self._data_file.write(np_array.tobytes(order='C'))
+        self._sizes.extend(np.asarray(sizes).tolist())
+
     def end_document(self):
         self._doc_idx.append(len(self._sizes))
 
@@ -22,9 +22,6 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
                                              os.path.pardir)))
 import time
 import math
-import torch
-import torch.nn.functional as F
-from tqdm import tqdm
 import random
 import numpy as np
 
@@ -33,14 +30,11 @@ import indexed_dataset
 
 random.seed(233)
 np.random.seed(233)
-g = torch.manual_seed(233)
-torch.cuda.manual_seed_all(233)
-torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
 
 class Encoder(object):
-    def __init__(self, args):
+    def __init__(self, args, dtype=np.int32):
         self.args = args
+        self.dtype = dtype
 
     def initializer(self):
         Encoder.tokenizer = CPM1Tokenizer(os.path.join(self.args.tokenizer_path, 'vocab.txt'))
@@ -57,28 +51,55 @@ class Encoder(object):
         if len(doc_ids) < 32:
             return None, None, 0
 
-        doc_ids.append(Encoder.tokenizer.eod_id)
-        doc_ids = [1] + doc_ids
-        doc_ids = [j for j in doc_ids if j != Encoder.tokenizer.unk_id]
+        doc_ids = np.array([1] + doc_ids + [Encoder.tokenizer.eod_id], dtype=self.dtype)
+        doc_ids = doc_ids[doc_ids != Encoder.tokenizer.unk_id]
 
-        contexts = []
-        labels = []
-        i = 0
+        # pieces of 512 tokens as views into `doc_ids`, a tail shorter than 32 tokens is dropped
+        contexts = np.split(doc_ids, np.arange(512, len(doc_ids), 512))
+        if len(contexts[-1]) < 32:
+            contexts.pop()
+        labels = contexts
 
-        while i < len(doc_ids):
-            piece = doc_ids[i:i+512]
-            if len(piece) < 32:
-                break
-            i += 512
+        return contexts, labels, len(line)
 
-            context = piece
-            label = piece
-            assert len(label) == len(context)
-            assert len(label) <= 512
-            contexts.append(context)
-            labels.append(label)
+    def encode_range(self, task):
+        # encode every line in a byte range of the input, so that one task carries many documents
+        path, start, end = task
+        with open(path, 'rb') as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
 
-        return contexts, labels, len(line)
+        contexts = []
+        labels = []
+        for line in lines:
+            context, label, _ = self.encode(line.decode('utf-8'))
+            if context is None or label is None:
+                continue
+            contexts.extend(context)
+            labels.extend(label)
+
+        # one flat buffer and a sizes array per range, rather than a small array per piece
+        context_sizes = np.array([len(context) for context in contexts], dtype=np.int64)
+        label_sizes = np.array([len(label) for label in labels], dtype=np.int64)
+        contexts = np.concatenate(contexts) if contexts else np.empty(0, dtype=self.dtype)
+        labels = np.concatenate(labels) if labels else np.empty(0, dtype=self.dtype)
+
+        return contexts, context_sizes, labels, label_sizes, len(lines), end - start
+
+def get_ranges(path, num_ranges):
+    # split the file into byte ranges of about the same size, each ending right after a newline
+    file_size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, num_ranges):
+            f.seek(max(file_size * k // num_ranges, bounds[-1]))
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(file_size)
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -114,16 +135,20 @@ def main():
     startup_start = time.time()
 
     uid = args.uid
-    print("Opening", args.input+str(uid)+".txt")
-    fin = open(args.input+str(uid)+".txt", 'r', encoding='utf-8')
+    input_file = args.input + str(uid) + ".txt"
+    print("Opening", input_file)
+
+    # uint16 halves the output when the vocabulary fits in it
+    tokenizer = CPM1Tokenizer(os.path.join(args.tokenizer_path, 'vocab.txt'))
+    dtype = indexed_dataset.best_fitting_dtype(len(tokenizer))
+    print(f"Vocab size: {len(tokenizer)}, token dtype: {np.dtype(dtype).name}")
 
-    encoder = Encoder(args)
-    # tokenizer = CPM1Tokenizer(os.path.join(args.tokenizer_path, 'vocab.txt'), space_token = "▂", line_token = "▃")
+    encoder = Encoder(args, dtype)
     # pool = Pool(args.workers, initializer=encoder.initializer)
     pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
     
-    # use the tokenizer to encode the sentences
-    encoded_docs = pool.imap_unordered(encoder.encode, fin, 10)
+    # use the tokenizer to encode the sentences, the workers read their byte ranges of the input themselves
+    encoded_docs = pool.imap_unordered(encoder.encode_range, get_ranges(input_file, args.workers * 8))
 
     level = "document"
 
@@ -135,8 +160,8 @@ def main():
     # target_bin_file = os.path.join(args.output_path,  "{}_{}_target_{}.bin".format(args.output_prefix, level, uid))
     # target_idx_file = os.path.join(args.output_path,  "{}_{}_target_{}.idx".format(args.output_prefix, level, uid))
     
-    builder_context = indexed_dataset.make_builder(context_bin_file, impl=args.dataset_impl, dtype=np.int32)
-    # builder_target = indexed_dataset.make_builder(target_bin_file, impl=args.dataset_impl, dtype=np.int32)
+    builder_context = indexed_dataset.make_builder(context_bin_file, impl=args.dataset_impl, dtype=dtype)
+    # builder_target = indexed_dataset.make_builder(target_bin_file, impl=args.dataset_impl, dtype=dtype)
 
     startup_end = time.time()
     proc_start = time.time()
@@ -145,21 +170,20 @@ def main():
 
     # sentinel_idx = tokenizer.vocab_size # start from the last token of the tokenizer
     # print("tokenizer vocab size:", encoder.initializer.vocab_size)
-    for i, (pair_ids, label_ids, bytes_processed) in enumerate(encoded_docs, start=1):
-        if pair_ids is None or label_ids is None:
-            continue
+    total_docs = 0
+    for pair_ids, pair_sizes, label_ids, label_sizes, docs_processed, bytes_processed in encoded_docs:
+        total_docs += docs_processed
         total_bytes_processed += bytes_processed
 
-        for pids, lids in zip(pair_ids, label_ids):
-            builder_context.add_item(torch.IntTensor(pids))
-            # builder_target.add_item(torch.IntTensor(lids))
+        builder_context.add_buffer(pair_ids, pair_sizes)
+        # builder_target.add_buffer(label_ids, label_sizes)
         
-        if i % args.log_interval == 0:
+        if total_docs // args.log_interval > (total_docs - docs_processed) // args.log_interval:
             current = time.time()
             elapsed = current - proc_start
             mbs = total_bytes_processed / elapsed / 1024 / 1024
-            print(f"Processed {i} documents",
-                  f"({i/elapsed} docs/s, {mbs} MB/s).",
+            print(f"Processed {total_docs} documents",
+                  f"({total_docs/elapsed} docs/s, {mbs} MB/s).",
                   file=sys.stderr)
 
     builder_context.finalize(context_idx_file)
@@ -21,6 +21,7 @@ cd -
 # python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_t5.py
 # python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_t5v1_1.py
 python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_flan_t5.py
+python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_attention.py
 # python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_mt5.py
 # python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_gpt2.py
 # python3 -m torch.distributed.launch ${DISTRIBUTED_ARGS} test_gptj.py
@@ -0,0 +1,82 @@
+#coding:utf-8
+
+import os
+import tempfile
+
+import torch
+import bmtrain as bmt
+
+from model_center.layer import Attention
+from model_center.model.basemodel import BaseModel
+
+class Block(torch.nn.Module):
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.self_att = Attention(**kwargs)
+
+    def forward(self, hidden_states, attention_mask):
+        return self.self_att(hidden_states, hidden_states, attention_mask)
+
+class Model(BaseModel):
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.layers = bmt.TransformerBlockList([bmt.CheckpointBlock(Block(**kwargs))])
+
+    def forward(self, hidden_states, attention_mask):
+        return self.layers(hidden_states, attention_mask)
+
+def to_legacy(state_dict, dim_q):
+    # split project_qkv back into the project_q/k/v layout of checkpoints saved before the fusion
+    legacy = {}
+    for key, value in state_dict.items():
+        if ".project_qkv." in key:
+            dim_kv = (value.size(0) - dim_q) // 2
+            for name, part in zip(["q", "k", "v"], value.split([dim_q, dim_kv, dim_kv], dim=0)):
+                legacy[key.replace(".project_qkv.", f".project_{name}.")] = part.clone()
+        else:
+            legacy[key] = value
+    return legacy
+
+def main():
+    bmt.init_distributed()
+
+    kwargs = dict(dim_in=128, dim_head=32, num_heads=4, bias=True, attn_scale=True)
+    dim_q = kwargs["num_heads"] * kwargs["dim_head"]
+
+    batch, seq_len = 2, 16
+    hidden_states = torch.randn(batch, seq_len, kwargs["dim_in"], dtype=torch.half, device="cuda")
+    valid = torch.arange(seq_len, device="cuda")[None, :] < torch.tensor([seq_len, 9], device="cuda")[:, None]
+    attention_mask = valid[:, None, :] & valid[:, :, None]
+
+    # Attention on its own, loaded with load_state_dict
+    attn = Attention(**kwargs)
+    bmt.init_parameters(attn)
+    out = attn(hidden_states, hidden_states, attention_mask)
+    assert not torch.isnan(out).any()
+
+    legacy_attn = Attention(**kwargs)
+    legacy_attn.load_state_dict(to_legacy(attn.state_dict(), dim_q))
+    legacy_out = legacy_attn(hidden_states, hidden_states, attention_mask)
+    print((out - legacy_out).abs().max())
+    assert torch.equal(out, legacy_out)
+
+    # Attention inside a CheckpointBlock of a model, loaded with bmt.load
+    model = Model(**kwargs)
+    bmt.init_parameters(model)
+    out = model(hidden_states, attention_mask)
+    assert not torch.isnan(out).any()
+
+    legacy = to_legacy(model.state_dict(), dim_q)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "legacy.pt")
+        if bmt.rank() == 0:
+            torch.save(legacy, path)
+        bmt.synchronize()
+        legacy_model = Model(**kwargs)
+        bmt.load(legacy_model, path)
+    legacy_out = legacy_model(hidden_states, attention_mask)
+    print((out - legacy_out).abs().max())
+    assert torch.equal(out, legacy_out)
+
+if __name__ == "__main__":
+    main()